@@ -1,6 +1,10 @@
-import base64
+import functools
+import hashlib
+import io
+import mimetypes
 import os
 import pathlib
+import sys
 import json
 import time
 
@@ -20,12 +24,19 @@ if DISABLE_CACHE:
     DEFAULT_API_CACHE_TTL = 0
     DEFAULT_INSIGHTS_CACHE_TTL = 0
 
+BINARY_SNIFF_SIZE = 8000  # bytes, same as git's binary detection
+# Budget for parsed responses kept in memory, measured by the size of their
+# JSON cache files on disk; the parsed objects take a few times more than that
+MAX_LOADED_RESPONSES_BYTES = 32 * 1024 * 1024  # 32 MB
+LOADED_RESPONSES = {}  # cache file -> (mtime_ns, file size, parsed response)
+
 
 def is_valid_repo_url(repo_url):
     git_cmd = git.cmd.Git()
     with git_cmd.custom_environment(GIT_TERMINAL_PROMPT="0"):
         try:
-            git_cmd.ls_remote(repo_url)
+            # Only ask for HEAD; listing every branch and tag is wasted work
+            git_cmd.ls_remote(repo_url, "HEAD")
             return True
         except:
             return False
@@ -35,8 +46,7 @@ def is_valid_repo_url(repo_url):
 
 
 def get_stats(path_str):
-    path = pathlib.Path(path_str)
-    stats = path.stat()
+    stats = os.stat(path_str)
     return {
         "size": stats.st_size,
         "modified_time": stats.st_mtime,
@@ -57,19 +67,52 @@ class GitProgress(git.remote.RemoteProgress):
         print(f"{op_code}, {cur_count}, {max_count}, {message}")
 
 
+def load_cached_response(cache_file, cache_stats):
+    cache_key = str(cache_file)
+    loaded = LOADED_RESPONSES.get(cache_key)
+    if loaded is not None and loaded[0] == cache_stats.st_mtime_ns:
+        return loaded[2]
+
+    with cache_file.open(mode="r") as f:
+        response = json.load(f)
+
+    # Keep the most recently loaded responses within the byte budget, evicting
+    # the oldest first; a response too big for the budget is never kept
+    LOADED_RESPONSES.pop(cache_key, None)
+    if cache_stats.st_size > MAX_LOADED_RESPONSES_BYTES:
+        return response
+
+    loaded_bytes = sum(entry[1] for entry in LOADED_RESPONSES.values())
+    while LOADED_RESPONSES and (
+        loaded_bytes + cache_stats.st_size > MAX_LOADED_RESPONSES_BYTES
+    ):
+        evicted = LOADED_RESPONSES.pop(next(iter(LOADED_RESPONSES)))
+        loaded_bytes -= evicted[1]
+
+    LOADED_RESPONSES[cache_key] = (
+        cache_stats.st_mtime_ns,
+        cache_stats.st_size,
+        response,
+    )
+    return response
+
+
 def get_repo(repo_url):
     if not is_valid_repo_url(repo_url):
         raise Exception(f"Invalid repo url: {repo_url}")
 
-    safe_repo_url = base64.b64encode(repo_url.encode("utf-8")).decode("utf-8")
+    safe_repo_url = hashlib.blake2b(
+        repo_url.encode("utf-8"), digest_size=16
+    ).hexdigest()
     cache_dir = f"/tmp/codecity/cache/{safe_repo_url}"
 
     cache_file = pathlib.Path(f"{cache_dir}/repo_data.json")
-    cached_at = cache_file.stat().st_mtime if cache_file.exists() else None
-    if cached_at is not None and time.time() < cached_at + DEFAULT_API_CACHE_TTL:
-        with cache_file.open(mode="r") as f:
-            response = json.load(f)
-        return response
+    cache_stats = cache_file.stat() if cache_file.exists() else None
+    if (
+        cache_stats is not None
+        and time.time() < cache_stats.st_mtime + DEFAULT_API_CACHE_TTL
+    ):
+        return load_cached_response(cache_file, cache_stats)
 
     repo_dir = pathlib.Path(f"{cache_dir}/repo")
     if repo_dir.exists():
@@ -102,7 +145,7 @@ def get_repo(repo_url):
 
     cache_file.parent.mkdir(parents=True, exist_ok=True)
     with cache_file.open(mode="w") as f:
-        json.dump(response, f)
+        json.dump(response, f, separators=(",", ":"))
 
     return response
 
@@ -148,9 +191,51 @@ def fetch_gh_repo_info(repo_owner, repo_name):
         raise
 
 
+@functools.lru_cache(maxsize=256)
+def get_mime_type_for_ext(ext):
+    # Any stem will do, mimetypes only reads the extensions
+    return mimetypes.guess_type(f"file{ext}")[0] or git.Blob.DEFAULT_MIME_TYPE
+
+
+def get_mime_type(blob):
+    # mimetypes looks at no more than the last two extensions of a name (the
+    # type, behind an optional encoding such as .gz), ignoring leading dots
+    name_parts = blob.name.lstrip(".").rsplit(".", 2)
+    ext = "".join(f".{part}" for part in name_parts[1:])
+    return get_mime_type_for_ext(ext)
+
+
+def load_blob_content(node, path):
+    try:
+        # Sniff for a NUL byte the way git does before reading and decoding the
+        # whole file, so large binaries are not pulled into memory
+        with path.open(mode="rb") as f:
+            if b"\0" in f.read(BINARY_SNIFF_SIZE):
+                node["content"] = None
+                node["isBinary"] = True
+                return
+
+            f.seek(0)
+            with io.TextIOWrapper(f) as text:
+                content = text.read()
+
+        # TextIOWrapper normalizes line endings, so counting "\n" (plus an
+        # unterminated last line) avoids building a list of every line
+        num_lines = content.count("\n")
+        if content and not content.endswith("\n"):
+            num_lines += 1
+        node["content"] = content
+        node["file_stats"]["num_lines"] = num_lines
+        node["isBinary"] = False
+    except UnicodeDecodeError:
+        node["content"] = None
+        node["isBinary"] = True
+    except Exception as e:
+        node["content"] = None
+        node["content_error"] = str(e)
+
+
 def get_repo_tree(repo):
-    repoTree = repo.tree()
-    dirTree = repoTree.traverse()
     processedTree = {}
     root_path = "."
     processedTree[root_path] = {
@@ -169,16 +254,25 @@ def get_repo_tree(repo):
             "num_child_trees": 0,
         },
     }
+    root_tree_stats = processedTree[root_path]["tree_stats"]
+
+    # An empty repo has no HEAD commit to take a tree from
+    if not repo.head.is_valid():
+        return processedTree
 
+    dirTree = repo.tree().traverse()
     for item in dirTree:
         full_path = pathlib.Path(item.abspath)
-        parent_path = full_path.parent.relative_to(repo.working_tree_dir)
-        parent_path_str = str(parent_path)
+        # Interning both a node's own path (its key) and its parent path lets
+        # the parent lookup below match on identity, and siblings share one
+        # parent path string instead of a copy each
+        item_path = sys.intern(item.path)
+        parent_path_str = sys.intern(item_path.rpartition("/")[0] or root_path)
         node = {
             "type": item.type,
-            "depth": 0,
+            "depth": item_path.count("/") + 1,
             "parent_path": parent_path_str,
-            "path": item.path,
+            "path": item_path,
             "name": item.name,
             "child_paths": [],
             "suffix": full_path.suffix,
@@ -193,40 +287,30 @@ def get_repo_tree(repo):
         }
 
         if item.type == "blob":
-            node["mime_type"] = item.mime_type
-            try:
-                node["content"] = full_path.read_text()
-                node["file_stats"]["num_lines"] = len(node["content"].splitlines())
-                node["isBinary"] = False
-            except UnicodeDecodeError:
-                node["content"] = None
-                node["isBinary"] = True
-            except Exception as e:
-                node["content"] = None
-                node["content_error"] = str(e)
+            node["mime_type"] = get_mime_type(item)
+            load_blob_content(node, full_path)
 
         parent_dirs = parent_path_str.split("/")
 
         if parent_path_str != root_path:
-            node["depth"] = len(parent_dirs) + 1
-            processedTree[root_path]["tree_stats"]["num_descendants"] += 1
-        else:
-            node["depth"] = len(parent_dirs)
-
-        for i in range(len(parent_dirs)):
-            ancestor_path = "/".join(parent_dirs[: i + 1])
-
-            if i == len(parent_dirs) - 1:
-                processedTree[ancestor_path]["tree_stats"]["num_children"] += 1
-                processedTree[ancestor_path]["child_paths"].append(item.path)
-
-                if item.type == "blob":
-                    processedTree[ancestor_path]["tree_stats"]["num_child_blobs"] += 1
-                elif item.type == "tree":
-                    processedTree[ancestor_path]["tree_stats"]["num_child_trees"] += 1
+            root_tree_stats["num_descendants"] += 1
 
+        ancestor_path = None
+        for parent_dir in parent_dirs:
+            ancestor_path = (
+                parent_dir if ancestor_path is None else f"{ancestor_path}/{parent_dir}"
+            )
             processedTree[ancestor_path]["tree_stats"]["num_descendants"] += 1
 
-        processedTree[item.path] = node
+        parent_node = processedTree[parent_path_str]
+        parent_node["child_paths"].append(item_path)
+        parent_tree_stats = parent_node["tree_stats"]
+        parent_tree_stats["num_children"] += 1
+        if item.type == "blob":
+            parent_tree_stats["num_child_blobs"] += 1
+        elif item.type == "tree":
+            parent_tree_stats["num_child_trees"] += 1
+
+        processedTree[item_path] = node
 
     return processedTree